@@ -3,6 +3,13 @@ import logging
 import json
 import subprocess
 import tempfile
+import io
+import argparse
+import socket
+import socketserver
+import hmac
+import uuid
+import httpx
 from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove
 from telegram.ext import (
     Application,
@@ -15,8 +22,11 @@ from telegram.ext import (
 import google.generativeai as genai
 from PIL import Image, ImageWin # Used for image validation/info, though not strictly for printing here
 from PyPDF2 import PdfReader
-import win32print
-import win32ui
+try:
+    import win32print
+    import win32ui
+except ImportError:  # Not on Windows; print agents can still run (e.g. with --dry-run)
+    win32print = win32ui = None
 import sqlite3
 import shutil
 from pathlib import Path
@@ -70,6 +80,11 @@ from PIL import Image, ImageOps
 
 def process_image(file_path, settings, printable_area=None):
     img = Image.open(file_path)
+    # Downscale planned by preflight for oversized images (JPEG draft mode decodes at reduced size)
+    downscale_to = settings.get('downscale_to')
+    if downscale_to:
+        img.draft(img.mode, tuple(downscale_to))
+        img.thumbnail(tuple(downscale_to), Image.LANCZOS)
     # Orientation
     if settings.get('orientation') == 'landscape' and img.width < img.height:
         img = img.rotate(90, expand=True)
@@ -93,8 +108,6 @@ def process_image(file_path, settings, printable_area=None):
     return processed_path
 
 # --- Print Manager Logic ---
-import win32print
-import win32ui
 from PIL import ImageWin
 
 def print_file(file_path, printer_name, settings, dry_run=False):
@@ -160,26 +173,35 @@ TELEGRAM_BOT_TOKEN =
 # GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 GEMINI_API_KEY = 
 
-# Check if environment variables are set
-if not TELEGRAM_BOT_TOKEN:
-    print("Error: TELEGRAM_BOT_TOKEN environment variable is not set.")
-    print("Please set it before running the script (e.g., export TELEGRAM_BOT_TOKEN='YOUR_TOKEN').")
-    exit(1)
-if not GEMINI_API_KEY:
-    print("Error: GEMINI_API_KEY environment variable is not set.")
-    print("Please set it before running the script (e.g., export GEMINI_API_KEY='YOUR_KEY').")
-    exit(1)
-
-# Configure the Gemini API
-genai.configure(api_key=GEMINI_API_KEY)
-# Initialize the Gemini model
-model = genai.GenerativeModel('gemini-2.0-flash')
+# Initialized by configure_bot() when running as the bot; print agents need neither key
+model = None
+
+def configure_bot():
+    """
+    Checks the bot's API keys and configures Gemini. Exits if a key is missing.
+    """
+    global model
+    # Check if environment variables are set
+    if not TELEGRAM_BOT_TOKEN:
+        print("Error: TELEGRAM_BOT_TOKEN environment variable is not set.")
+        print("Please set it before running the script (e.g., export TELEGRAM_BOT_TOKEN='YOUR_TOKEN').")
+        exit(1)
+    if not GEMINI_API_KEY:
+        print("Error: GEMINI_API_KEY environment variable is not set.")
+        print("Please set it before running the script (e.g., export GEMINI_API_KEY='YOUR_KEY').")
+        exit(1)
+    # Configure the Gemini API
+    genai.configure(api_key=GEMINI_API_KEY)
+    # Initialize the Gemini model
+    model = genai.GenerativeModel('gemini-2.0-flash')
 
 # --- Logging Setup ---
 # Configure basic logging to show info, warnings, and errors
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
 )
+# httpx logs every request URL at INFO, and Telegram file URLs contain the bot token
+logging.getLogger("httpx").setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
 # --- Conversation States ---
@@ -323,6 +345,204 @@ def get_pdf_page_count(file_path: str):
         logger.error(f"Error reading PDF page count for {file_path}: {e}")
         return None
 
+# --- File Preflight ---
+# Cheap checks run before a job is queued: the size Telegram reports is checked before
+# downloading, the file's magic bytes are sniffed from its first bytes before the full
+# download, then its metadata is read without decoding pixels or loading PDF pages.
+MAX_FILE_SIZE = 20 * 1024 * 1024  # Telegram bots cannot download larger files anyway
+MAX_IMAGE_PIXELS = 40_000_000  # Larger images get a downscale planned before rendering
+MAX_DECODE_PIXELS = 400_000_000  # Larger images are rejected; even a downscale would need to decode them
+MAX_PDF_PAGES = 500
+PREFLIGHT_HEADER_BYTES = 32  # Enough for every signature below, including BMP's DIB header size
+# Preflight sizes every image and rejects those over MAX_DECODE_PIXELS, so Pillow's own
+# decompression bomb limit only needs to stop anything larger
+Image.MAX_IMAGE_PIXELS = MAX_DECODE_PIXELS
+# ([(offset, magic bytes), ...], file type, accepted extensions - the first one is used if the name has none of them)
+FILE_SIGNATURES = [
+    ([(0, b'%PDF-')], 'pdf', ['.pdf']),
+    ([(0, b'\xff\xd8\xff')], 'image', ['.jpg', '.jpeg']),
+    ([(0, b'\x89PNG\r\n\x1a\n')], 'image', ['.png']),
+    ([(0, b'GIF87a')], 'image', ['.gif']),
+    ([(0, b'GIF89a')], 'image', ['.gif']),
+    ([(0, b'RIFF'), (8, b'WEBP')], 'image', ['.webp']),
+    ([(0, b'II*\x00')], 'image', ['.tif', '.tiff']),
+    ([(0, b'MM\x00*')], 'image', ['.tif', '.tiff']),
+]
+# Sizes of the DIB header that follows the 14-byte BMP file header
+BMP_DIB_HEADER_SIZES = [12, 40, 52, 56, 64, 108, 124]
+
+def claimed_file_type(mime_type):
+    """
+    Maps the MIME type Telegram reports for a document to 'pdf', 'image' or 'other'.
+    """
+    if mime_type == 'application/pdf':
+        return 'pdf'
+    if mime_type and mime_type.startswith('image/'):
+        return 'image'
+    return 'other'
+
+def check_declared_size(file_size):
+    """
+    Returns a rejection reason if the size reported by Telegram is too large, otherwise None.
+    """
+    if file_size and file_size > MAX_FILE_SIZE:
+        return f"file is {file_size // (1024 * 1024)} MB, the limit is {MAX_FILE_SIZE // (1024 * 1024)} MB"
+    return None
+
+def sniff_file_type(header: bytes):
+    """
+    Identifies a file from its first bytes (at least 18 are needed to recognise a BMP).
+    Returns (file_type, extensions) or (None, None) if the signature is unknown.
+    """
+    for checks, file_type, extensions in FILE_SIGNATURES:
+        if all(header[offset:offset + len(magic)] == magic for offset, magic in checks):
+            return file_type, extensions
+    # "BM" alone is too common at the start of text files; also check the DIB header size
+    if header[:2] == b'BM' and len(header) >= 18 and int.from_bytes(header[14:18], 'little') in BMP_DIB_HEADER_SIZES:
+        return 'image', ['.bmp']
+    return None, None
+
+def read_image_size(data: bytes):
+    """
+    Returns (width, height, extensions) from the image header without decoding pixel data,
+    or None if the image cannot be read. extensions are the ones Pillow registers for the format.
+    Raises Image.DecompressionBombError for images far beyond MAX_DECODE_PIXELS.
+    """
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            extensions = [ext for ext, image_format in Image.registered_extensions().items() if image_format == img.format]
+            return img.size[0], img.size[1], extensions
+    except Image.DecompressionBombError:
+        raise
+    except Exception as e:
+        logger.error(f"Error reading image header: {e}")
+        return None
+
+def read_pdf_page_count(data: bytes):
+    """
+    Returns the page count stored in the PDF's page tree root (/Root -> /Pages -> /Count),
+    which only needs the xref table and trailer, not the pages themselves.
+    Returns None if the file is not a valid PDF.
+    """
+    try:
+        reader = PdfReader(io.BytesIO(data))
+        return int(reader.trailer['/Root']['/Pages']['/Count'])
+    except Exception as e:
+        logger.error(f"Error reading PDF trailer: {e}")
+        return None
+
+def count_selected_pages(pages, page_count):
+    """
+    Returns how many pages a range like '1-3,5' selects out of page_count.
+    Falls back to page_count for 'all' or anything that cannot be parsed.
+    """
+    if not pages or str(pages).lower() == 'all':
+        return page_count
+    selected = set()
+    try:
+        for part in str(pages).split(','):
+            first, _, last = part.partition('-')
+            # Clamp to the document so a range like '1-9999999999' stays cheap
+            first = max(int(first), 1)
+            last = min(int(last) if last else first, page_count)
+            selected.update(range(first, last + 1))
+    except ValueError:
+        return page_count
+    return len(selected) or page_count
+
+async def fetch_file_header(file):
+    """
+    Downloads only the first PREFLIGHT_HEADER_BYTES of a Telegram file, using a range
+    request and closing the stream once enough has arrived.
+    Returns None if the header cannot be fetched; the full download still follows.
+    """
+    try:
+        header = b''
+        async with httpx.AsyncClient() as client:
+            async with client.stream('GET', file.file_path, headers={'Range': f"bytes=0-{PREFLIGHT_HEADER_BYTES - 1}"}) as response:
+                response.raise_for_status()
+                async for chunk in response.aiter_bytes():
+                    header += chunk
+                    if len(header) >= PREFLIGHT_HEADER_BYTES:
+                        break
+        return header[:PREFLIGHT_HEADER_BYTES]
+    except Exception as e:
+        # Only the exception type: the file URL in httpx errors contains the bot token
+        logger.warning(f"Could not fetch file header for preflight: {type(e).__name__}")
+        return None
+
+def preflight_header(header: bytes, claimed_type):
+    """
+    Checks a file's first bytes against the type Telegram reported for it.
+    Returns a rejection reason, or None if the file may be downloaded.
+    """
+    file_type, extensions = sniff_file_type(header)
+    if file_type is None:
+        if claimed_type == 'pdf':
+            return "file does not look like a valid pdf"
+        # Images without a signature above may still be readable by Pillow;
+        # other documents keep going to the printer's own handler
+        return None
+    if claimed_type in ['pdf', 'image'] and file_type != claimed_type:
+        return f"file was sent as {claimed_type} but its contents are {file_type}"
+    return None
+
+def preflight_file(data: bytes, claimed_type):
+    """
+    Checks a downloaded file before it is queued, using only its header and metadata.
+    Returns a dictionary with 'ok', 'reason', 'file_type', 'extensions', 'page_count'
+    and 'downscale_to' (a (width, height) target for oversized images, or None).
+    """
+    result = {'ok': True, 'reason': None, 'file_type': claimed_type, 'extensions': None,
+              'page_count': 1, 'downscale_to': None}
+    reason = preflight_header(data[:PREFLIGHT_HEADER_BYTES], claimed_type)
+    if reason:
+        result.update(ok=False, reason=reason)
+        return result
+    file_type, extensions = sniff_file_type(data[:PREFLIGHT_HEADER_BYTES])
+    if file_type is None and claimed_type == 'image':
+        # Formats without a signature above (e.g. HEIC with a plugin) may still be readable by Pillow
+        file_type = 'image'
+    if file_type is None:
+        return result
+    result.update(file_type=file_type, extensions=extensions)
+    if file_type == 'pdf':
+        page_count = read_pdf_page_count(data)
+        if page_count is None:
+            result.update(ok=False, reason="PDF is corrupt or unreadable")
+        elif page_count > MAX_PDF_PAGES:
+            result.update(ok=False, reason=f"PDF has {page_count} pages, the limit is {MAX_PDF_PAGES}")
+        else:
+            result['page_count'] = page_count
+    else:
+        try:
+            size = read_image_size(data)
+        except Image.DecompressionBombError:
+            result.update(ok=False, reason="image is too large to print")
+            return result
+        if size is None:
+            if extensions:
+                result.update(ok=False, reason="image is corrupt or unreadable")
+            else:
+                # Unknown to us and to Pillow: hand it to the printer's own handler as before
+                result.update(file_type='other')
+            return result
+        width, height, pillow_extensions = size
+        result['extensions'] = extensions or pillow_extensions or None
+        if width * height > MAX_DECODE_PIXELS:
+            result.update(ok=False, reason=f"image is {width}x{height}, too large to print")
+        elif width * height > MAX_IMAGE_PIXELS:
+            factor = (MAX_IMAGE_PIXELS / (width * height)) ** 0.5
+            result['downscale_to'] = (int(width * factor), int(height * factor))
+    return result
+
+def estimate_pages(page_count, settings):
+    """
+    Estimates the sheets a job will print from its page count, page range and copies.
+    """
+    copies = max(1, int(settings.get('copies', 1)))
+    return count_selected_pages(settings.get('pages', 'all'), page_count) * copies
+
 selected_printer_global = None  # Store the selected printer for use by the bot
 
 def cli_select_printer():
@@ -445,9 +665,17 @@ def submit_print_job(file_path: str, printer_name: str, settings: dict):
 # --- Local Database and File Management ---
 DB_PATH = 'printbot.db'
 FILES_DIR = Path('print_files')
-FILES_DIR.mkdir(exist_ok=True)
+# Columns added to print_jobs after its first release; init_db adds any that are missing
+PRINT_JOB_COLUMNS = {
+    'rendered_path': 'TEXT',
+    'file_type': 'TEXT',
+    'page_estimate': 'INTEGER',
+    'lease_owner': 'TEXT',
+    'lease_expires': 'REAL',
+}
 
 def init_db():
+    FILES_DIR.mkdir(exist_ok=True)
     conn = sqlite3.connect(DB_PATH)
     c = conn.cursor()
     c.execute('''CREATE TABLE IF NOT EXISTS print_jobs (
@@ -459,14 +687,24 @@ def init_db():
         local_path TEXT,
         datetime TEXT,
         print_settings TEXT,
-        status TEXT
+        status TEXT,
+        rendered_path TEXT,
+        file_type TEXT,
+        page_estimate INTEGER,
+        lease_owner TEXT,
+        lease_expires REAL
     )''')
+    # Add columns introduced after the table was first created
+    c.execute("PRAGMA table_info(print_jobs)")
+    existing_columns = [row[1] for row in c.fetchall()]
+    for column, column_type in PRINT_JOB_COLUMNS.items():
+        if column not in existing_columns:
+            c.execute(f"ALTER TABLE print_jobs ADD COLUMN {column} {column_type}")
     conn.commit()
     conn.close()
 
-init_db()
 
-def save_file_and_log_job(file, file_id, original_filename, user, username, print_settings, status):
+def save_file_and_log_job(file, file_id, original_filename, user, username, print_settings, status, file_type=None, page_estimate=None):
     # Save file to print_files/original_filename (with unique suffix if needed)
     safe_name = original_filename.replace('/', '_').replace('\\', '_')
     dest_path = FILES_DIR / safe_name
@@ -479,12 +717,13 @@ def save_file_and_log_job(file, file_id, original_filename, user, username, prin
     # Log to DB
     conn = sqlite3.connect(DB_PATH)
     c = conn.cursor()
-    c.execute('''INSERT INTO print_jobs (telegram_user, telegram_username, telegram_file_id, original_filename, local_path, datetime, print_settings, status)
-                 VALUES (?, ?, ?, ?, ?, datetime('now'), ?, ?)''',
-              (user, username, file_id, original_filename, str(dest_path), json.dumps(print_settings), status))
+    c.execute('''INSERT INTO print_jobs (telegram_user, telegram_username, telegram_file_id, original_filename, local_path, datetime, print_settings, status, file_type, page_estimate)
+                 VALUES (?, ?, ?, ?, ?, datetime('now'), ?, ?, ?, ?)''',
+              (user, username, file_id, original_filename, str(dest_path), json.dumps(print_settings), status, file_type, page_estimate))
+    job_id = c.lastrowid
     conn.commit()
     conn.close()
-    return str(dest_path)
+    return job_id, str(dest_path)
 
 def list_print_jobs(filter_by=None, value=None):
     conn = sqlite3.connect(DB_PATH)
@@ -536,14 +775,16 @@ async def handle_file_message(update: Update, context: ContextTypes.DEFAULT_TYPE
             files.append({
                 'file_id': photo.file_id,
                 'file_type': 'image',
-                'file_name': f'photo_{photo.file_id}.jpg'
+                'file_name': f'photo_{photo.file_id}.jpg',
+                'file_size': photo.file_size
             })
     if update.message.document:
         doc = update.message.document
         files.append({
             'file_id': doc.file_id,
-            'file_type': 'pdf' if doc.mime_type == 'application/pdf' else 'image',
-            'file_name': doc.file_name
+            'file_type': claimed_file_type(doc.mime_type),
+            'file_name': doc.file_name,
+            'file_size': doc.file_size
         })
     if not files:
         await update.message.reply_text("Please send at least one photo or PDF document for printing.")
@@ -551,30 +792,55 @@ async def handle_file_message(update: Update, context: ContextTypes.DEFAULT_TYPE
     # 2. Parse settings for all files
     print_settings_list = parse_instructions(message_text, len(files))
     log_event(f"Gemini extracted settings: {print_settings_list}")
-    # 3. For each file, process and print
+    # 3. For each file, download and queue it; the render and print stages take it from there
+    job_ids = []
+    rejected = []
     for idx, file_info in enumerate(files):
         file_id = file_info['file_id']
-        file_type = file_info['file_type']
         file_name = file_info['file_name']
-        # Download file
-        with tempfile.NamedTemporaryFile(delete=False, suffix=f"_{file_name}") as temp_file:
-            file_path = temp_file.name
-            file = await context.bot.get_file(file_id)
-            await file.download_to_memory(out=temp_file)
+        # Preflight: skip the download entirely if Telegram already reports the file as too large
+        reason = check_declared_size(file_info['file_size'])
+        if reason:
+            rejected.append(f"{file_name}: {reason}")
+            log_event(f"Rejected {file_name} before download: {reason}")
+            continue
+        file = await context.bot.get_file(file_id)
+        # Sniff the first bytes before spending bandwidth on the full download
+        header = await fetch_file_header(file)
+        reason = preflight_header(header, file_info['file_type']) if header is not None else None
+        if reason:
+            rejected.append(f"{file_name}: {reason}")
+            log_event(f"Rejected {file_name} before download: {reason}")
+            continue
+        data = bytes(await file.download_as_bytearray())
+        preflight = preflight_file(data, file_info['file_type'])
+        if not preflight['ok']:
+            rejected.append(f"{file_name}: {preflight['reason']}")
+            log_event(f"Rejected {file_name} in preflight: {preflight['reason']}")
+            continue
+        # Name the file after its real contents so the render and print stages pick the right handler
+        if preflight['extensions'] and Path(file_name).suffix.lower() not in preflight['extensions']:
+            file_name += preflight['extensions'][0]
         settings = print_settings_list[idx] if idx < len(print_settings_list) else {}
-        processed_file_path = file_path
-        if file_type == 'image':
-            processed_file_path = process_image(file_path, settings)
-            log_event(f"Image processed and saved to: {processed_file_path}")
-        # Print file
-        print_success = print_file(processed_file_path, selected_printer_global, settings, dry_run=False)
-        log_event(f"Print job for file {file_name} success: {print_success}")
-        # Clean up
-        if os.path.exists(file_path):
-            os.unlink(file_path)
-        if processed_file_path != file_path and os.path.exists(processed_file_path):
-            os.unlink(processed_file_path)
-    await update.message.reply_text("All print jobs processed. Check logs for details.")
+        if preflight['downscale_to']:
+            settings['downscale_to'] = preflight['downscale_to']
+        page_estimate = estimate_pages(preflight['page_count'], settings)
+        job_id, local_path = save_file_and_log_job(
+            data, file_id, file_name, str(user_id), update.effective_user.username, settings, 'downloaded',
+            file_type=preflight['file_type'], page_estimate=page_estimate
+        )
+        job_ids.append(job_id)
+        log_event(f"[Job {job_id}] Downloaded {file_name} to {local_path} ({page_estimate} page(s) estimated)")
+    render_wakeup.set()
+    reply = ""
+    if job_ids:
+        reply += (
+            f"Queued {len(job_ids)} print job(s): {', '.join(f'#{job_id}' for job_id in job_ids)}.\n"
+            "Use /jobstatus <job_id> to follow progress.\n"
+        )
+    if rejected:
+        reply += "Not printed:\n" + "\n".join(rejected)
+    await update.message.reply_text(reply.strip())
     return ConversationHandler.END
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -616,38 +882,510 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
             "An unexpected error occurred! Please try again or contact the bot administrator."
         )
 
-# --- Print Job Queue Worker ---
-def process_pending_jobs():
+# --- Print Job Pipeline ---
+# Jobs move through the print_jobs table as: downloaded -> rendered -> printing -> done/failed.
+# The render stage keeps up to RENDER_AHEAD jobs pre-rendered while the printer is busy,
+# so the print stage only ever spools device-ready data.
+RENDER_AHEAD = 3
+RENDER_AHEAD_PAGES = 50  # Also cap the look-ahead by the preflight page estimates
+PIPELINE_POLL_SECONDS = 5  # Fallback poll interval if a wakeup is missed
+render_wakeup = threading.Event()  # Set when a job is downloaded or a look-ahead slot frees up
+print_wakeup = threading.Event()  # Set when a job has been rendered
+
+def get_printable_area(printer_name):
+    """
+    Returns the (width, height) printable area of the printer in device pixels,
+    or None if it cannot be queried (e.g. no Windows printer DC available).
+    """
+    try:
+        hdc = win32ui.CreateDC()
+        hdc.CreatePrinterDC(printer_name)
+        printable_area = hdc.GetDeviceCaps(8), hdc.GetDeviceCaps(10)
+        hdc.DeleteDC()
+        return printable_area
+    except Exception as e:
+        logger.warning(f"Could not query printable area for '{printer_name}': {e}")
+        return None
+
+def render_job(local_path, file_type, settings, printable_area):
+    """
+    Turns a downloaded file into device-ready data and returns its path.
+    Images are rotated, bordered, downscaled as planned by preflight and scaled to the
+    printable area up front; other files are passed through unchanged.
+    """
+    if file_type is None:
+        # Jobs queued before preflight existed have no file_type; go by extension
+        file_type = 'image' if os.path.splitext(local_path)[1].lower() in ['.jpg', '.jpeg', '.png', '.bmp'] else 'other'
+    if file_type == 'image':
+        return process_image(local_path, settings, printable_area)
+    return local_path
+
+def render_pending_jobs(printable_area):
     while True:
+        render_wakeup.wait(PIPELINE_POLL_SECONDS)
+        render_wakeup.clear()
         conn = sqlite3.connect(DB_PATH)
         c = conn.cursor()
-        c.execute("SELECT id, local_path, print_settings, status, original_filename FROM print_jobs WHERE status = 'pending' ORDER BY id ASC LIMIT 1")
-        job = c.fetchone()
-        if job:
-            job_id, local_path, print_settings_json, status, original_filename = job
-            try:
-                print_settings = json.loads(print_settings_json)
-                c.execute("UPDATE print_jobs SET status = 'printing' WHERE id = ?", (job_id,))
-                conn.commit()
-                log_event(f"[Job {job_id}] Printing {original_filename} with settings: {print_settings}")
-                success = print_file(local_path, selected_printer_global, print_settings, dry_run=False)
-                if success:
-                    c.execute("UPDATE print_jobs SET status = 'done' WHERE id = ?", (job_id,))
-                    log_event(f"[Job {job_id}] Print completed.")
-                else:
+        try:
+            while True:
+                # Bounded look-ahead: stop once enough jobs or pages are waiting for the printer
+                c.execute("SELECT COUNT(*), COALESCE(SUM(page_estimate), 0) FROM print_jobs WHERE status = 'rendered'")
+                rendered_jobs, rendered_pages = c.fetchone()
+                if rendered_jobs >= RENDER_AHEAD or rendered_pages >= RENDER_AHEAD_PAGES:
+                    break
+                c.execute("SELECT id, local_path, file_type, print_settings, original_filename FROM print_jobs WHERE status IN ('pending', 'downloaded') ORDER BY id ASC LIMIT 1")
+                job = c.fetchone()
+                if not job:
+                    break
+                job_id, local_path, file_type, print_settings_json, original_filename = job
+                try:
+                    print_settings = json.loads(print_settings_json)
+                    rendered_path = render_job(local_path, file_type, print_settings, printable_area)
+                    c.execute("UPDATE print_jobs SET status = 'rendered', rendered_path = ? WHERE id = ?", (rendered_path, job_id))
+                    log_event(f"[Job {job_id}] Rendered {original_filename} to {rendered_path}")
+                except Exception as e:
                     c.execute("UPDATE print_jobs SET status = 'failed' WHERE id = ?", (job_id,))
-                    log_event(f"[Job {job_id}] Print failed.")
+                    log_event(f"[Job {job_id}] Render error: {e}")
                 conn.commit()
-            except Exception as e:
-                c.execute("UPDATE print_jobs SET status = 'failed' WHERE id = ?", (job_id,))
-                conn.commit()
-                log_event(f"[Job {job_id}] Print error: {e}")
+                print_wakeup.set()
+        except Exception as e:
+            # e.g. "database is locked"; keep the stage alive and retry on the next wakeup
+            logger.error(f"Render stage error: {e}", exc_info=True)
+        finally:
+            conn.close()
+
+def claim_rendered_job(owner, lease_seconds=None):
+    """
+    Atomically moves the oldest rendered job to 'printing' under a lease held by owner.
+    A lease_seconds of None gives a lease that never expires (the in-process print stage).
+    Returns (job_id, rendered_path, print_settings, original_filename) or None if nothing is ready.
+    """
+    conn = sqlite3.connect(DB_PATH)
+    c = conn.cursor()
+    try:
+        while True:
+            c.execute("SELECT id, rendered_path, print_settings, original_filename FROM print_jobs WHERE status = 'rendered' ORDER BY id ASC LIMIT 1")
+            job = c.fetchone()
+            if not job:
+                return None
+            lease_expires = time.time() + lease_seconds if lease_seconds else None
+            c.execute("UPDATE print_jobs SET status = 'printing', lease_owner = ?, lease_expires = ? WHERE id = ? AND status = 'rendered'",
+                      (owner, lease_expires, job[0]))
+            claimed = c.rowcount == 1
+            conn.commit()
+            if claimed:  # Otherwise another worker got it first; try the next one
+                render_wakeup.set()  # A look-ahead slot just freed up
+                return job
+    finally:
         conn.close()
-        time.sleep(5)  # Check every 5 seconds
 
-# Start the worker thread on startup
-worker_thread = threading.Thread(target=process_pending_jobs, daemon=True)
-worker_thread.start()
+def renew_lease(job_id, owner, lease_seconds):
+    """
+    Extends the lease on a printing job. Returns False if owner no longer holds it.
+    """
+    conn = sqlite3.connect(DB_PATH)
+    c = conn.cursor()
+    c.execute("UPDATE print_jobs SET lease_expires = ? WHERE id = ? AND lease_owner = ? AND status = 'printing'",
+              (time.time() + lease_seconds, job_id, owner))
+    renewed = c.rowcount == 1
+    conn.commit()
+    conn.close()
+    return renewed
+
+def finish_job(job_id, owner, success):
+    """
+    Marks a leased job as done or failed and removes its rendered copy.
+    Returns False if owner no longer holds the lease (the job was handed to someone else).
+    """
+    conn = sqlite3.connect(DB_PATH)
+    c = conn.cursor()
+    c.execute("UPDATE print_jobs SET status = ?, lease_owner = NULL, lease_expires = NULL WHERE id = ? AND lease_owner = ? AND status = 'printing'",
+              ('done' if success else 'failed', job_id, owner))
+    finished = c.rowcount == 1
+    conn.commit()
+    c.execute("SELECT local_path, rendered_path FROM print_jobs WHERE id = ?", (job_id,))
+    job = c.fetchone()
+    conn.close()
+    if not job:
+        log_event(f"[Job {job_id}] Ignoring result from {owner}: no such job.")
+        return False
+    local_path, rendered_path = job
+    if not finished:
+        log_event(f"[Job {job_id}] Ignoring result from {owner}: lease no longer held.")
+        return False
+    log_event(f"[Job {job_id}] Print {'completed' if success else 'failed'} on {owner}.")
+    # The original download stays in FILES_DIR for /listfiles; only the rendered copy is temporary
+    if rendered_path and rendered_path != local_path and os.path.exists(rendered_path):
+        os.unlink(rendered_path)
+    return True
+
+def release_leases(owner=None):
+    """
+    Puts printing jobs back in the rendered queue: those held by owner, or, if owner
+    is None, those whose lease has expired. Returns the number of jobs released.
+    """
+    conn = sqlite3.connect(DB_PATH)
+    c = conn.cursor()
+    if owner:
+        c.execute("UPDATE print_jobs SET status = 'rendered', lease_owner = NULL, lease_expires = NULL WHERE status = 'printing' AND lease_owner = ?", (owner,))
+    else:
+        c.execute("UPDATE print_jobs SET status = 'rendered', lease_owner = NULL, lease_expires = NULL WHERE status = 'printing' AND lease_expires < ?", (time.time(),))
+    released = c.rowcount
+    conn.commit()
+    conn.close()
+    if released:
+        log_event(f"Re-queued {released} job(s) from {owner or 'expired leases'}.")
+        print_wakeup.set()
+    return released
+
+LOCAL_PRINTER_OWNER = 'local'
+
+def release_stale_local_jobs():
+    """
+    Re-queues jobs a previous run was printing in-process, or from before leases existed.
+    Their leases never expire, so they never reported back and only a restart can release them.
+    Jobs that were never rendered go back to the render stage.
+    """
+    conn = sqlite3.connect(DB_PATH)
+    c = conn.cursor()
+    c.execute("""UPDATE print_jobs
+                 SET status = CASE WHEN rendered_path IS NULL THEN 'pending' ELSE 'rendered' END,
+                     lease_owner = NULL, lease_expires = NULL
+                 WHERE status = 'printing' AND (lease_owner = ? OR lease_owner IS NULL)""", (LOCAL_PRINTER_OWNER,))
+    released = c.rowcount
+    conn.commit()
+    conn.close()
+    if released:
+        log_event(f"Re-queued {released} job(s) left printing by a previous run.")
+
+def print_rendered_jobs(printer_name):
+    while True:
+        print_wakeup.wait(PIPELINE_POLL_SECONDS)
+        print_wakeup.clear()
+        try:
+            while True:
+                job = claim_rendered_job(LOCAL_PRINTER_OWNER)
+                if not job:
+                    break
+                job_id, rendered_path, print_settings_json, original_filename = job
+                try:
+                    print_settings = json.loads(print_settings_json)
+                    log_event(f"[Job {job_id}] Printing {original_filename} with settings: {print_settings}")
+                    success = print_file(rendered_path, printer_name, print_settings, dry_run=False)
+                except Exception as e:
+                    success = False
+                    log_event(f"[Job {job_id}] Print error: {e}")
+                finish_job(job_id, LOCAL_PRINTER_OWNER, success)
+        except Exception as e:
+            # e.g. "database is locked" or a rendered file that cannot be removed yet;
+            # keep the stage alive and retry on the next wakeup
+            logger.error(f"Print stage error: {e}", exc_info=True)
+
+def start_pipeline(printer_name=None):
+    """
+    Starts the render stage and, if a printer is given, the in-process print stage.
+    Without a printer, rendered jobs are left for print agents to claim.
+    Images are pre-scaled for the local printer only (not at all without one). print_file
+    on an agent can shrink an image to fit its own printer but never enlarges it, so agents
+    with a larger printable area print local-sized images.
+    """
+    release_stale_local_jobs()
+    printable_area = get_printable_area(printer_name) if printer_name else None
+    threading.Thread(target=render_pending_jobs, args=(printable_area,), daemon=True).start()
+    if printer_name:
+        threading.Thread(target=print_rendered_jobs, args=(printer_name,), daemon=True).start()
+
+# --- Print Agents ---
+# Print agents are separate processes (on this or another machine) that claim rendered jobs
+# from the bot's queue server and print them on their own printer.
+# The protocol is one JSON object per line over TCP ("host:port") or a Unix socket ("unix:/path"):
+#   agent -> server: {"op": "hello", "agent": name, "printer": printer, "token": token} -> {"op": "ok"}
+#                    {"op": "claim"}                          -> {"op": "job", ...} + file bytes, or {"op": "idle"}
+#                    {"op": "heartbeat", "job_id": id}        (no reply; renews the lease)
+#                    {"op": "result", "job_id": id, "success": bool} -> {"op": "ok"}
+# Errors are answered with {"op": "error", "code": ..., "message": ...}.
+# Leases belong to a single connection, so a job whose agent disconnects, or whose lease is
+# not renewed (agent hung), goes back to the rendered queue.
+# The queue server hands out users' files, so it only listens on loopback or a Unix socket
+# unless PRINTBOT_AGENT_TOKEN is set; agents must then send the same token in hello.
+QUEUE_ADDRESS = os.getenv("PRINTBOT_QUEUE_ADDRESS", "127.0.0.1:8765")
+AGENT_TOKEN = os.getenv("PRINTBOT_AGENT_TOKEN", "")
+LEASE_SECONDS = 60
+HEARTBEAT_SECONDS = 15
+AGENT_POLL_SECONDS = 2
+AGENT_RECONNECT_SECONDS = 10
+# Live agents talk at least every HEARTBEAT_SECONDS, so a silent connection is half-open (e.g. the
+# other host lost power); both ends give up on it after this long
+CONNECTION_TIMEOUT_SECONDS = 2 * LEASE_SECONDS
+TRANSFER_CHUNK_SIZE = 64 * 1024
+
+def send_message(sock_file, message):
+    sock_file.write((json.dumps(message) + '\n').encode())
+    sock_file.flush()
+
+def read_message(sock_file):
+    line = sock_file.readline()
+    if not line:
+        raise ConnectionError("Connection closed by peer")
+    return json.loads(line)
+
+def parse_tcp_address(address):
+    """
+    Splits "host:port" or "[ipv6-host]:port" into (host, port).
+    """
+    host, port = address.rsplit(':', 1)
+    return host.strip('[]'), int(port)
+
+def is_local_address(address):
+    if address.startswith('unix:'):
+        return True
+    return parse_tcp_address(address)[0] in ['127.0.0.1', 'localhost', '::1']
+
+class PrintQueueHandler(socketserver.StreamRequestHandler):
+    """
+    Serves one connected print agent: hands out leased jobs, streams their files,
+    renews leases on heartbeats and records results.
+    """
+    connected_agents = set()  # Names of agents with a live connection
+    connected_agents_lock = threading.Lock()
+    timeout = CONNECTION_TIMEOUT_SECONDS  # Applied to the socket by StreamRequestHandler.setup()
+
+    def handle(self):
+        self.agent_name = None
+        self.lease_owner = None  # Unique per connection, so reconnects and name clashes cannot touch other leases
+        try:
+            while True:
+                message = read_message(self.rfile)
+                try:
+                    if not self.handle_message(message):
+                        break
+                except (KeyError, TypeError) as e:
+                    self.send_error('malformed', f"malformed message: {e!r}")
+        except (ConnectionError, OSError, ValueError) as e:
+            log_event(f"Print agent '{self.agent_name}' disconnected: {e}")
+        finally:
+            if self.lease_owner:
+                # The agent can no longer report back, so do not wait for its leases to expire
+                release_leases(self.lease_owner)
+                with self.connected_agents_lock:
+                    self.connected_agents.discard(self.agent_name)
+
+    def send_error(self, code, text):
+        send_message(self.wfile, {'op': 'error', 'code': code, 'message': text})
+
+    def handle_message(self, message):
+        """
+        Handles one message from the agent. Returns False to close the connection.
+        """
+        if not isinstance(message, dict):
+            raise TypeError("message must be a JSON object")
+        op = message.get('op')
+        if op == 'hello':
+            return self.hello(message)
+        if self.lease_owner is None:
+            self.send_error('hello_required', 'send hello first')
+        elif op == 'claim':
+            self.send_job()
+        elif op == 'heartbeat':
+            if not renew_lease(message['job_id'], self.lease_owner, LEASE_SECONDS):
+                log_event(f"[Job {message['job_id']}] Heartbeat from '{self.agent_name}' for a lease it no longer holds.")
+        elif op == 'result':
+            finish_job(message['job_id'], self.lease_owner, bool(message.get('success', False)))
+            send_message(self.wfile, {'op': 'ok'})
+        else:
+            self.send_error('unknown_op', f"unknown op {op}")
+        return True
+
+    def hello(self, message):
+        if self.lease_owner:
+            self.send_error('hello_repeated', 'already said hello')
+            return True
+        if AGENT_TOKEN and not hmac.compare_digest(str(message.get('token', '')).encode(), AGENT_TOKEN.encode()):
+            log_event(f"Rejected print agent from {self.client_address}: bad token.")
+            self.send_error('unauthorized', 'bad agent token')
+            return False
+        agent_name = str(message['agent'])
+        with self.connected_agents_lock:
+            if agent_name in self.connected_agents:
+                self.send_error('name_in_use', f"an agent named '{agent_name}' is already connected")
+                return False
+            self.connected_agents.add(agent_name)
+        self.agent_name = agent_name
+        self.lease_owner = f"{agent_name}#{uuid.uuid4().hex[:8]}"
+        log_event(f"Print agent '{agent_name}' connected (printer: {message.get('printer')}).")
+        send_message(self.wfile, {'op': 'ok'})
+        return True
+
+    def send_job(self):
+        job = claim_rendered_job(self.lease_owner, LEASE_SECONDS)
+        if not job:
+            send_message(self.wfile, {'op': 'idle'})
+            return
+        job_id, rendered_path, print_settings_json, original_filename = job
+        try:
+            size = os.path.getsize(rendered_path)
+        except OSError as e:
+            log_event(f"[Job {job_id}] Rendered file missing: {e}")
+            finish_job(job_id, self.lease_owner, False)
+            send_message(self.wfile, {'op': 'idle'})
+            return
+        log_event(f"[Job {job_id}] Sending {original_filename} to print agent '{self.agent_name}'.")
+        send_message(self.wfile, {
+            'op': 'job',
+            'job_id': job_id,
+            'file_name': os.path.basename(rendered_path),
+            'size': size,
+            'settings': json.loads(print_settings_json),
+            'lease_seconds': LEASE_SECONDS,
+        })
+        # The agent only starts heartbeats once the file has arrived, so keep the lease alive here
+        last_renewal = time.time()
+        with open(rendered_path, 'rb') as f:
+            while True:
+                chunk = f.read(TRANSFER_CHUNK_SIZE)
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+                if time.time() - last_renewal > HEARTBEAT_SECONDS:
+                    if not renew_lease(job_id, self.lease_owner, LEASE_SECONDS):
+                        raise ConnectionError(f"lease on job {job_id} lost during transfer")
+                    last_renewal = time.time()
+        self.wfile.flush()
+        renew_lease(job_id, self.lease_owner, LEASE_SECONDS)
+
+class PrintQueueServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class PrintQueueServerIPv6(PrintQueueServer):
+    address_family = socket.AF_INET6
+
+def reap_expired_leases():
+    while True:
+        time.sleep(HEARTBEAT_SECONDS)
+        release_leases()
+
+def start_queue_server(address):
+    """
+    Starts the queue server for print agents on "host:port" or "unix:/path" in background threads.
+    Exits if the address is reachable from other machines and no agent token is set.
+    """
+    if not AGENT_TOKEN and not is_local_address(address):
+        print(f"Error: the print queue would listen on {address} without authentication.")
+        print("Set PRINTBOT_AGENT_TOKEN to a shared secret (and the same on every print agent).")
+        exit(1)
+    if address.startswith('unix:'):
+        path = address[len('unix:'):]
+        if os.path.exists(path):
+            os.unlink(path)
+        server = socketserver.ThreadingUnixStreamServer(path, PrintQueueHandler)
+        server.daemon_threads = True
+    else:
+        host, port = parse_tcp_address(address)
+        server_class = PrintQueueServerIPv6 if ':' in host else PrintQueueServer
+        server = server_class((host, port), PrintQueueHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    threading.Thread(target=reap_expired_leases, daemon=True).start()
+    logger.info(f"Print queue server listening on {address}")
+    return server
+
+def connect_to_queue(address):
+    if address.startswith('unix:'):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(CONNECTION_TIMEOUT_SECONDS)
+        sock.connect(address[len('unix:'):])
+        return sock
+    # The timeout also covers later reads, so a half-open connection ends in a reconnect
+    return socket.create_connection(parse_tcp_address(address), timeout=CONNECTION_TIMEOUT_SECONDS)
+
+def run_print_agent(address, printer_name, agent_name, token=AGENT_TOKEN, dry_run=False):
+    """
+    Runs a print agent: claims jobs from the queue server at address, prints them on
+    printer_name and reports the result. Reconnects if the server goes away and
+    stops if the server rejects the token.
+    """
+    while True:
+        try:
+            serve_print_agent(address, printer_name, agent_name, token, dry_run)
+        except PermissionError as e:
+            log_event(f"Print agent '{agent_name}' was refused by the queue server: {e}")
+            return
+        except (ConnectionError, OSError, ValueError) as e:
+            log_event(f"Print agent '{agent_name}' lost the queue server ({e}); reconnecting in {AGENT_RECONNECT_SECONDS}s.")
+            time.sleep(AGENT_RECONNECT_SECONDS)
+
+def receive_job_file(sock_file, file_name, size):
+    """
+    Streams a job's file from the socket to a temporary file and returns its path.
+    The temporary file is removed if the transfer fails.
+    """
+    # Stream the file to disk in chunks rather than holding it in memory
+    with tempfile.NamedTemporaryFile(delete=False, suffix=f"_{os.path.basename(file_name)}") as temp_file:
+        file_path = temp_file.name
+        try:
+            remaining = size
+            while remaining:
+                chunk = sock_file.read(min(TRANSFER_CHUNK_SIZE, remaining))
+                if not chunk:
+                    raise ConnectionError("Connection closed during file transfer")
+                temp_file.write(chunk)
+                remaining -= len(chunk)
+        except BaseException:
+            temp_file.close()
+            os.unlink(file_path)
+            raise
+    return file_path
+
+def serve_print_agent(address, printer_name, agent_name, token, dry_run):
+    sock = connect_to_queue(address)
+    sock_file = sock.makefile('rwb')
+    send_lock = threading.Lock()  # The heartbeat thread writes to the same socket
+
+    def send(message):
+        with send_lock:
+            send_message(sock_file, message)
+
+    try:
+        send({'op': 'hello', 'agent': agent_name, 'printer': printer_name, 'token': token})
+        reply = read_message(sock_file)
+        if reply.get('code') == 'unauthorized':
+            raise PermissionError(reply['message'])
+        if reply['op'] != 'ok':
+            raise ConnectionError(reply.get('message', 'hello rejected'))
+        log_event(f"Print agent '{agent_name}' connected to {address}, printing on '{printer_name}'.")
+        while True:
+            send({'op': 'claim'})
+            message = read_message(sock_file)
+            if message['op'] != 'job':
+                time.sleep(AGENT_POLL_SECONDS)
+                continue
+            job_id = message['job_id']
+            file_path = receive_job_file(sock_file, message['file_name'], message['size'])
+            stop_heartbeat = threading.Event()
+
+            def heartbeat():
+                while not stop_heartbeat.wait(HEARTBEAT_SECONDS):
+                    try:
+                        send({'op': 'heartbeat', 'job_id': job_id})
+                    except OSError:
+                        return
+
+            threading.Thread(target=heartbeat, daemon=True).start()
+            try:
+                log_event(f"[Job {job_id}] Printing {message['file_name']} on '{printer_name}'.")
+                success = print_file(file_path, printer_name, message['settings'], dry_run=dry_run)
+            except Exception as e:
+                success = False
+                log_event(f"[Job {job_id}] Print error: {e}")
+            finally:
+                stop_heartbeat.set()
+                if os.path.exists(file_path):
+                    os.unlink(file_path)
+            send({'op': 'result', 'job_id': job_id, 'success': success})
+            read_message(sock_file)
+    finally:
+        sock_file.close()
+        sock.close()
 
 # --- Telegram /jobstatus command ---
 async def jobstatus(update: Update, context):
@@ -657,26 +1395,57 @@ async def jobstatus(update: Update, context):
     job_id = context.args[0]
     conn = sqlite3.connect(DB_PATH)
     c = conn.cursor()
-    c.execute("SELECT id, original_filename, datetime, status FROM print_jobs WHERE id = ?", (job_id,))
+    c.execute("SELECT id, original_filename, datetime, status, page_estimate FROM print_jobs WHERE id = ?", (job_id,))
     job = c.fetchone()
     conn.close()
     if not job:
         await update.message.reply_text(f"No job found with ID {job_id}.")
         return
-    await update.message.reply_text(f"Job {job[0]}: {job[1]}\nTime: {job[2]}\nStatus: {job[3]}")
+    await update.message.reply_text(f"Job {job[0]}: {job[1]}\nTime: {job[2]}\nStatus: {job[3]}\nPages: {job[4] or '?'}")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Telegram Print Bot")
+    parser.add_argument('mode', nargs='?', choices=['bot', 'agent'], default='bot',
+                        help="'bot' runs the Telegram bot and job queue, 'agent' runs a print agent for it")
+    parser.add_argument('--queue-address', default=QUEUE_ADDRESS,
+                        help="Queue server address, 'host:port' or 'unix:/path' (default: %(default)s)")
+    parser.add_argument('--agents-only', action='store_true',
+                        help="bot mode: do not print locally, leave all jobs to print agents")
+    parser.add_argument('--printer', help="agent mode: printer to use (asked interactively if omitted)")
+    parser.add_argument('--agent-name', default=f"{socket.gethostname()}-{os.getpid()}",
+                        help="agent mode: unique name for this agent (default: %(default)s)")
+    parser.add_argument('--agent-token', default=AGENT_TOKEN,
+                        help="agent mode: shared secret the bot was started with (default: $PRINTBOT_AGENT_TOKEN)")
+    parser.add_argument('--dry-run', action='store_true', help="agent mode: log jobs instead of printing them")
+    return parser.parse_args()
 
 def main() -> None:
+    args = parse_args()
+    global selected_printer_global
+    if args.mode == 'agent':
+        printer_name = args.printer or cli_select_printer()
+        if not printer_name:
+            print("No valid printer selected. Exiting.")
+            return
+        run_print_agent(args.queue_address, printer_name, args.agent_name, token=args.agent_token, dry_run=args.dry_run)
+        return
+    configure_bot()
+    init_db()
     print("\n==============================")
     print("Welcome to the Telegram Print Bot!")
     print("At startup, you can select a printer from the list of printers available on your Windows PC.")
     print("The app will robustly detect all available printers and allow you to choose before printing.")
     print("==============================\n")
-    global selected_printer_global
-    selected_printer_global = cli_select_printer()
-    if not selected_printer_global:
-        print("No valid printer selected. Exiting.")
-        return
-    print(f"Printer '{selected_printer_global}' will be used for all print jobs. Starting Telegram bot...\n")
+    if args.agents_only:
+        print("No local printer: all print jobs will be handed to print agents. Starting Telegram bot...\n")
+    else:
+        selected_printer_global = cli_select_printer()
+        if not selected_printer_global:
+            print("No valid printer selected. Exiting.")
+            return
+        print(f"Printer '{selected_printer_global}' will be used for print jobs, together with any connected print agents. Starting Telegram bot...\n")
+    start_pipeline(selected_printer_global)
+    start_queue_server(args.queue_address)
     application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
     conv_handler = ConversationHandler(
         entry_points=[